@@ -4,335 +4,759 @@ Distributed Tracing for Database Operations
 Tracks query execution across microservices
 """
 
-import psycopg2
-import uuid
+import asyncio
+import numpy as np
+from psycopg2.extras import execute_batch
+from psycopg2.pool import ThreadedConnectionPool
+import csv
+import io
+import os
+import queue
+import random
+import threading
 import time
 import json
-from datetime import datetime
+import sys
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from typing import Dict, Optional
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# Trace/span ID handed out for traces dropped by sampling
+_NOOP = "00000000-0000-0000-0000-000000000000"
+
+# Trace/span status codes as stored in the SMALLINT status columns
+_STATUS = {'in_progress': 0, 'success': 1, 'error': 2}
+_STATUS_NAMES = {code: name for name, code in _STATUS.items()}
+
+
+def _covered_time(starts, ends, covered_until: float):
+    """Time covered by intervals sorted by start, beyond covered_until
+    
+    Returns the newly covered time and the new covered_until, so the
+    union can be carried across successive windows of intervals.
+    """
+    covered = np.maximum.accumulate(np.concatenate(([covered_until], ends[:-1])))
+    total = float(np.clip(ends - np.maximum(starts, covered), 0, None).sum())
+    if len(ends):
+        covered_until = max(covered_until, float(ends.max()))
+    return total, covered_until
+
 
 class DistributedTracer:
     
     def __init__(self):
-        self.conn = None
-        self.active_traces = {}
+        self.dsn = {
+            'host': 'localhost',
+            'port': 5449,
+            'dbname': 'tracing_db',
+            'user': 'postgres',
+            'password': 'postgres'
+        }
+        self.pool = None
+        self._cursors = {}
+        self.export_batch_size = 500
+        self.export_interval = 0.01
+        self._export_q = queue.SimpleQueue()
+        self._export_stop = threading.Event()
+        self._export_conn = None
+        self._export_cursor = None
+        self._export_prepared = False
+        self._export_thread = None
+        # Date from which create_partitions() has to run again
+        self._partitions_due = date.min
+        self._trace_start: dict[str, int] = {}
+        # span_id -> (trace_id, start time)
+        self._span_start: dict[str, tuple[str, int]] = {}
+        # Events of open traces, held until end_trace decides whether to keep them
+        self._pending: dict[str, list] = {}
+        self._pending_lock = threading.Lock()
+        self.sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+        # Tail sampling: successful traces faster than this are discarded
+        self.slow_trace_ms = float(os.environ.get("TRACE_SLOW_MS", "0"))
         
     def connect(self):
         try:
-            self.conn = psycopg2.connect(
-                host='localhost',
-                port=5449,
-                dbname='tracing_db',
-                user='postgres',
-                password='postgres'
-            )
-            self.conn.autocommit = True
+            self.pool = ThreadedConnectionPool(2, 32, **self.dsn)
+            # The exporter keeps one pooled connection for its lifetime so
+            # its prepared statements stay valid
+            self._export_conn = self._getconn()
+            self._export_cursor = self._export_conn.cursor()
+            self._export_prepared = False
+            # close() leaves the stop flag set
+            self._export_stop.clear()
+            self._export_thread = threading.Thread(target=self._exporter, daemon=True)
+            self._export_thread.start()
             logger.info("Connected to database")
             return True
         except Exception as e:
             logger.error(f"Connection failed: {e}")
             return False
     
+    def _getconn(self):
+        conn = self.pool.getconn()
+        if not conn.autocommit:
+            conn.autocommit = True
+        return conn
+    
+    @contextmanager
+    def _connection(self):
+        """Borrow a connection from the pool"""
+        conn = self._getconn()
+        try:
+            yield conn
+        finally:
+            self.pool.putconn(conn)
+            # The pool closes returned connections beyond minconn; drop
+            # their cached cursor along with them
+            if conn.closed:
+                self._cursors.pop(conn, None)
+
+    @contextmanager
+    def _cursor(self):
+        """Yield the cached cursor of a connection borrowed from the pool"""
+        with self._connection() as conn:
+            # A pooled connection is only ever held by one thread at a
+            # time, so its cursor can be reused across calls
+            cursor = self._cursors.get(conn)
+            if cursor is None:
+                cursor = self._cursors[conn] = conn.cursor()
+            yield cursor
+    
     def setup(self):
-        cursor = self.conn.cursor()
+        with self._cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS traces (
+                    trace_id UUID PRIMARY KEY,
+                    service_name VARCHAR(100),
+                    operation_name VARCHAR(100),
+                    start_time TIMESTAMP,
+                    end_time TIMESTAMP,
+                    duration_ms DECIMAL(10,2),
+                    status SMALLINT NOT NULL
+                );
+            
+                -- Range-partitioned by month on start_time; see create_partitions()
+                CREATE TABLE IF NOT EXISTS spans (
+                    span_id UUID,
+                    trace_id UUID REFERENCES traces(trace_id),
+                    parent_span_id UUID,
+                    service_name VARCHAR(100),
+                    operation_name VARCHAR(100),
+                    start_time TIMESTAMP NOT NULL,
+                    end_time TIMESTAMP,
+                    duration_ms DECIMAL(10,2),
+                    status SMALLINT NOT NULL,
+                    PRIMARY KEY (span_id, start_time)
+                ) PARTITION BY RANGE (start_time);
+                
+                CREATE TABLE IF NOT EXISTS spans_default PARTITION OF spans DEFAULT;
+            
+                -- Query text is only read by analyze_trace, so it lives outside
+                -- the hot spans rows
+                CREATE TABLE IF NOT EXISTS spans_details (
+                    span_id UUID PRIMARY KEY,
+                    db_query TEXT,
+                    rows_affected INT
+                );
+            
+                -- start_time is left NULL for end-only rows of spans that
+                -- were already exported
+                CREATE UNLOGGED TABLE IF NOT EXISTS spans_stage (
+                    LIKE spans,
+                    db_query TEXT,
+                    rows_affected INT
+                );
+                ALTER TABLE spans_stage ALTER COLUMN start_time DROP NOT NULL;
+            
+                CREATE INDEX IF NOT EXISTS idx_traces_service ON traces(service_name);
+                CREATE INDEX IF NOT EXISTS idx_spans_trace ON spans(trace_id);
+                CREATE INDEX IF NOT EXISTS idx_spans_start_brin
+                    ON spans USING brin(start_time) WITH (pages_per_range = 32);
+                CREATE INDEX IF NOT EXISTS idx_spans_service_duration
+                    ON spans(service_name, duration_ms);
+            """)
+        self.create_partitions()
+        logger.info("Tracing tables initialized")
+    
+    def create_partitions(self, months: int = 2):
+        """Create monthly spans partitions starting from the current month
+        
+        setup() calls this, and the exporter calls it again on the first
+        batch of each new month, so next month's partition always exists
+        before its spans arrive. Spans outside the created range land in
+        spans_default, and a month that already has rows there cannot get
+        its own partition until they are moved out.
+        """
+        start = date.today().replace(day=1)
+        due = (start + timedelta(days=32)).replace(day=1)
+        with self._cursor() as cursor:
+            for _ in range(months):
+                end = (start + timedelta(days=32)).replace(day=1)
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS spans_{start:%Y_%m}
+                    PARTITION OF spans
+                    FOR VALUES FROM ('{start}') TO ('{end}')
+                """)
+                start = end
+        self._partitions_due = due
+    
+    def close(self):
+        """Write out everything still queued and stop the exporter"""
+        if self._export_thread:
+            self._flush()
+            self._export_stop.set()
+            self._export_thread.join()
+            self._export_thread = None
+        if self.pool:
+            if self._export_conn:
+                self.pool.putconn(self._export_conn)
+                self._export_conn = self._export_cursor = None
+            self._cursors.clear()
+            self.pool.closeall()
+            self.pool = None
+    
+    def _flush(self):
+        """Block until everything queued so far has been written"""
+        thread = self._export_thread
+        if thread is None:
+            return
+        done = threading.Event()
+        self._export_q.put(('flush', done))
+        # Nothing will answer if the exporter has died
+        while not done.wait(0.1):
+            if not thread.is_alive():
+                logger.error("Trace exporter is not running; queued traces not written")
+                return
+    
+    def _exporter(self):
+        """Drain the export queue into Postgres in batches"""
+        while not self._export_stop.is_set():
+            try:
+                batch = [self._export_q.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            
+            # Keep collecting until the batch is full or the window closes;
+            # a flush request is written out straight away
+            deadline = time.monotonic() + self.export_interval
+            while len(batch) < self.export_batch_size and batch[-1][0] != 'flush':
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._export_q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            self._write(batch)
+            
+            for kind, item in batch:
+                if kind == 'flush':
+                    item.set()
+    
+    def _write(self, batch: list):
+        """Export a batch, falling back to one trace at a time if it fails"""
+        try:
+            self._export(batch)
+            return
+        except Exception as e:
+            logger.error(f"Trace export failed: {e}")
+        
+        # The batch is one transaction, so a single bad row rolled back every
+        # trace in it; write each trace bundle (or lone late event) on its own
+        # so only the bad trace is lost
+        items = [item for item in batch if item[0] != 'flush']
+        if len(items) < 2:
+            return
+        failed = 0
+        for item in items:
+            try:
+                self._export([item])
+            except Exception as e:
+                failed += 1
+                logger.error(f"Trace export failed: {e}")
+        logger.error(f"Dropped {failed} of {len(items)} queued traces/events")
+    
+    def _prepare_statements(self, cursor):
+        """PREPARE the exporter's DML once per connection"""
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS traces (
-                trace_id VARCHAR(36) PRIMARY KEY,
-                service_name VARCHAR(100),
-                operation_name VARCHAR(100),
-                start_time TIMESTAMP,
-                end_time TIMESTAMP,
-                duration_ms DECIMAL(10,2),
-                status VARCHAR(20),
-                metadata JSONB
-            );
+            PREPARE ins_trace (uuid, varchar, varchar, timestamp,
+                               timestamp, numeric, smallint) AS
+                INSERT INTO traces (trace_id, service_name, operation_name,
+                                    start_time, end_time, duration_ms, status)
+                VALUES ($1, $2, $3, $4, $5, $6, $7);
             
-            CREATE TABLE IF NOT EXISTS spans (
-                span_id VARCHAR(36) PRIMARY KEY,
-                trace_id VARCHAR(36) REFERENCES traces(trace_id),
-                parent_span_id VARCHAR(36),
-                service_name VARCHAR(100),
-                operation_name VARCHAR(100),
-                start_time TIMESTAMP,
-                end_time TIMESTAMP,
-                duration_ms DECIMAL(10,2),
-                db_query TEXT,
-                rows_affected INT,
-                status VARCHAR(20)
-            );
+            -- spans has no unique key on span_id alone (the partition key is
+            -- part of the primary key), so new and already-exported spans
+            -- are merged separately instead of with ON CONFLICT.
+            -- Spans recorded after their trace ended are exported on their
+            -- own; skip them if tail sampling discarded the trace.
+            PREPARE ins_spans AS
+                INSERT INTO spans
+                SELECT span_id, trace_id, parent_span_id, service_name,
+                       operation_name, start_time, end_time, duration_ms, status
+                FROM spans_stage st
+                WHERE start_time IS NOT NULL
+                  AND EXISTS (SELECT 1 FROM traces t WHERE t.trace_id = st.trace_id);
             
-            CREATE INDEX idx_traces_service ON traces(service_name);
-            CREATE INDEX idx_spans_trace ON spans(trace_id);
+            PREPARE upd_spans AS
+                UPDATE spans
+                SET end_time = st.end_time,
+                    duration_ms = st.duration_ms,
+                    status = st.status
+                FROM spans_stage st
+                WHERE st.start_time IS NULL
+                  AND spans.span_id = st.span_id;
+            
+            PREPARE merge_span_details AS
+                INSERT INTO spans_details
+                SELECT span_id, db_query, rows_affected
+                FROM spans_stage st
+                WHERE db_query IS NOT NULL
+                  AND EXISTS (SELECT 1 FROM traces t WHERE t.trace_id = st.trace_id)
+                ON CONFLICT (span_id) DO UPDATE
+                SET db_query = EXCLUDED.db_query,
+                    rows_affected = EXCLUDED.rows_affected;
         """)
-        cursor.close()
-        logger.info("Tracing tables initialized")
+    
+    def _export(self, batch: list):
+        """Write a batch of queued trace/span events in one transaction"""
+        traces = {}
+        spans = {}
+        
+        # Kept traces arrive as one bundle of all their events, so a trace's
+        # end always meets its start in the same batch
+        events = []
+        for kind, item in batch:
+            if kind == 'trace':
+                events.extend(item)
+            else:
+                events.append((kind, item))
+        
+        # Collapse start/end events for the same trace or span into one row
+        for kind, item in events:
+            if kind == 'trace_start':
+                traces[item[0]] = item
+            elif kind == 'trace_end':
+                traces[item[0]][4:] = item[1:]
+            elif kind == 'span_start':
+                spans[item[0]] = item
+            elif kind == 'span_end':
+                row = spans.get(item[0])
+                if row is None:
+                    # Span start went out in an earlier batch; stage the end
+                    # columns only and let the merge update the existing row
+                    row = spans[item[0]] = [item[0], item[1]] + [None] * 9
+                row[6:] = item[2:]
+        
+        if not (traces or spans):
+            return
+        
+        if date.today() >= self._partitions_due:
+            self.create_partitions()
+        
+        cursor = self._export_cursor
+        try:
+            if not self._export_prepared:
+                self._prepare_statements(cursor)
+                self._export_prepared = True
+            
+            cursor.execute("BEGIN")
+            if traces:
+                execute_batch(cursor, "EXECUTE ins_trace (%s, %s, %s, %s, %s, %s, %s)",
+                              traces.values(), page_size=self.export_batch_size)
+            if spans:
+                buf = io.StringIO()
+                csv.writer(buf, delimiter='\t').writerows(spans.values())
+                buf.seek(0)
+                cursor.copy_expert(
+                    "COPY spans_stage FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t')", buf
+                )
+                cursor.execute(
+                    "EXECUTE ins_spans; EXECUTE upd_spans; EXECUTE merge_span_details;"
+                    "TRUNCATE spans_stage"
+                )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    
+    def _record(self, trace_id: str, event: tuple):
+        """Hold an event with its open trace, or export it if the trace has ended"""
+        with self._pending_lock:
+            events = self._pending.get(trace_id)
+            if events is None:
+                self._export_q.put(event)
+            else:
+                events.append(event)
+    
+    def _new_id(self) -> str:
+        # Straight from the OS: a seeded generator would be copied into
+        # forked workers and hand out the same IDs there
+        return os.urandom(16).hex()
     
     def start_trace(self, service_name: str, operation_name: str) -> str:
         """Start a new distributed trace"""
-        trace_id = str(uuid.uuid4())
+        # The module generator is reseeded in forked children
+        if random.random() >= self.sample_rate:
+            return _NOOP
         
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            INSERT INTO traces (trace_id, service_name, operation_name, 
-                                start_time, status)
-            VALUES (%s, %s, %s, NOW(), 'in_progress')
-        """, (trace_id, service_name, operation_name))
-        cursor.close()
-        
-        self.active_traces[trace_id] = {
-            'service': service_name,
-            'operation': operation_name,
-            'start_time': time.time()
-        }
+        trace_id = self._new_id()
         
-        logger.info(f"Started trace: {trace_id[:8]}... ({service_name}/{operation_name})")
+        # Rows follow the traces insert column order
+        with self._pending_lock:
+            self._pending[trace_id] = [(
+                'trace_start',
+                [trace_id, service_name, operation_name, datetime.now(), None, None,
+                 _STATUS['in_progress']]
+            )]
+        
+        self._trace_start[trace_id] = time.perf_counter_ns()
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Started trace: %s... (%s/%s)", trace_id[:8], service_name, operation_name)
         return trace_id
     
     def end_trace(self, trace_id: str, status: str = 'success'):
         """End a distributed trace"""
-        if trace_id not in self.active_traces:
-            logger.warning(f"Trace {trace_id} not found")
+        if trace_id == _NOOP:
+            return
+        
+        # Fail on an unknown status before any trace state is dropped
+        code = _STATUS[status]
+        start = self._trace_start.pop(trace_id, None)
+        if start is None:
+            logger.warning("Trace %s not found", trace_id)
             return
         
-        trace_info = self.active_traces[trace_id]
-        duration = (time.time() - trace_info['start_time']) * 1000
+        duration = (time.perf_counter_ns() - start) / 1_000_000
         
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            UPDATE traces
-            SET end_time = NOW(), duration_ms = %s, status = %s
-            WHERE trace_id = %s
-        """, (duration, status, trace_id))
-        cursor.close()
-        
-        del self.active_traces[trace_id]
-        logger.info(f"Ended trace: {trace_id[:8]}... ({duration:.2f}ms)")
+        # Queue the bundle under the lock too: once the trace is gone from
+        # _pending, _record() exports late events directly, and they must
+        # not overtake the trace's own events in the queue
+        with self._pending_lock:
+            events = self._pending.pop(trace_id)
+            
+            # Tail sampling: only slow traces, or ones where anything failed,
+            # are worth keeping
+            keep = (duration >= self.slow_trace_ms or status != 'success'
+                    or any(kind == 'span_end' and item[4] != _STATUS['success']
+                           for kind, item in events))
+            if keep:
+                events.append(
+                    ('trace_end', (trace_id, datetime.now(), duration, code))
+                )
+                self._export_q.put_nowait(('trace', events))
+        
+        if not keep:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Discarded trace: %s... (%.2fms)", trace_id[:8], duration)
+            return
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Ended trace: %s... (%.2fms)", trace_id[:8], duration)
     
     def create_span(self, trace_id: str, service_name: str, 
                     operation_name: str, parent_span_id: Optional[str] = None) -> str:
         """Create a span within a trace"""
-        span_id = str(uuid.uuid4())
+        if trace_id == _NOOP:
+            return _NOOP
         
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            INSERT INTO spans (span_id, trace_id, parent_span_id, 
-                               service_name, operation_name, start_time, status)
-            VALUES (%s, %s, %s, %s, %s, NOW(), 'in_progress')
-        """, (span_id, trace_id, parent_span_id, service_name, operation_name))
-        cursor.close()
+        span_id = self._new_id()
+        
+        self._span_start[span_id] = (trace_id, time.perf_counter_ns())
+        
+        # Rows follow the spans_stage column order so they can be COPY'd as-is
+        self._record(trace_id, (
+            'span_start',
+            [span_id, trace_id, parent_span_id, service_name, operation_name,
+             datetime.now(), None, None, _STATUS['in_progress'], None, None]
+        ))
         
         return span_id
     
     def end_span(self, span_id: str, query: str = None, 
                  rows_affected: int = 0, status: str = 'success'):
         """End a span"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            UPDATE spans
-            SET end_time = NOW(),
-                duration_ms = EXTRACT(EPOCH FROM (NOW() - start_time)) * 1000,
-                db_query = %s,
-                rows_affected = %s,
-                status = %s
-            WHERE span_id = %s
-        """, (query, rows_affected, status, span_id))
-        cursor.close()
+        if span_id == _NOOP:
+            return
+        
+        # Fail on an unknown status before the span's start is dropped
+        code = _STATUS[status]
+        entry = self._span_start.pop(span_id, None)
+        if entry is None:
+            # Unknown or already ended; an end-only row would overwrite the
+            # stored span's end_time and duration
+            logger.warning("Span %s not found", span_id)
+            return
+        
+        trace_id, start = entry
+        duration = (time.perf_counter_ns() - start) / 1_000_000
+        
+        self._record(trace_id, (
+            'span_end',
+            (span_id, trace_id, datetime.now(), duration, code,
+             query, rows_affected)
+        ))
     
-    def simulate_microservice_operation(self):
+    async def simulate_microservice_operation(self):
         """Simulate a complex microservice operation with DB calls"""
         
-        print("\n" + "=" * 80)
-        print("SIMULATING: User Order Creation Flow")
-        print("=" * 80)
+        out: list[str] = []
+        emit = out.append
+        
+        emit("\n" + "=" * 80)
+        emit("SIMULATING: User Order Creation Flow")
+        emit("=" * 80)
         
         # Start main trace
         trace_id = self.start_trace('api-gateway', 'create_order')
         
+        # The services run concurrently, so each flow collects its own lines
+        # and the report is assembled in span order afterwards.
+        
         # Span 1: User Service - Validate User
-        print("\n[1] User Service: Validating user...")
-        span1 = self.create_span(trace_id, 'user-service', 'validate_user')
-        time.sleep(0.05)
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM pg_database LIMIT 1")
-        cursor.fetchall()
-        cursor.close()
-        self.end_span(span1, "SELECT * FROM users WHERE user_id = 123", 1)
-        print("    Duration: 50ms | Status: SUCCESS")
+        async def user_flow():
+            lines = ["\n[1] User Service: Validating user..."]
+            span1 = self.create_span(trace_id, 'user-service', 'validate_user')
+            await asyncio.sleep(0.05)
+            self.end_span(span1, "SELECT * FROM users WHERE user_id = 123", 1)
+            lines.append("    Duration: 50ms | Status: SUCCESS")
+            return lines
         
         # Span 2: Inventory Service - Check Stock
-        print("\n[2] Inventory Service: Checking stock...")
-        span2 = self.create_span(trace_id, 'inventory-service', 'check_stock')
-        time.sleep(0.08)
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM pg_database LIMIT 1")
-        cursor.fetchall()
-        cursor.close()
-        self.end_span(span2, "SELECT stock FROM products WHERE product_id = 456", 1)
-        print("    Duration: 80ms | Status: SUCCESS")
+        async def stock_flow():
+            lines = ["\n[2] Inventory Service: Checking stock..."]
+            span2 = self.create_span(trace_id, 'inventory-service', 'check_stock')
+            await asyncio.sleep(0.08)
+            self.end_span(span2, "SELECT stock FROM products WHERE product_id = 456", 1)
+            lines.append("    Duration: 80ms | Status: SUCCESS")
+            return lines
         
         # Span 3: Order Service - Create Order
-        print("\n[3] Order Service: Creating order...")
-        span3 = self.create_span(trace_id, 'order-service', 'create_order')
-        
-        # Sub-span: Insert order
-        span3a = self.create_span(trace_id, 'order-service', 'insert_order', span3)
-        time.sleep(0.03)
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM pg_database LIMIT 1")
-        cursor.fetchall()
-        cursor.close()
-        self.end_span(span3a, "INSERT INTO orders VALUES (...)", 1)
-        print("    [3a] Insert order: 30ms")
-        
-        # Sub-span: Update inventory
-        span3b = self.create_span(trace_id, 'order-service', 'update_inventory', span3)
-        time.sleep(0.04)
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM pg_database LIMIT 1")
-        cursor.fetchall()
-        cursor.close()
-        self.end_span(span3b, "UPDATE products SET stock = stock - 1", 1)
-        print("    [3b] Update inventory: 40ms")
-        
-        self.end_span(span3, status='success')
-        print("    Total: 70ms | Status: SUCCESS")
+        async def order_flow():
+            lines = ["\n[3] Order Service: Creating order..."]
+            span3 = self.create_span(trace_id, 'order-service', 'create_order')
+            
+            # Sub-span: Insert order
+            span3a = self.create_span(trace_id, 'order-service', 'insert_order', span3)
+            await asyncio.sleep(0.03)
+            self.end_span(span3a, "INSERT INTO orders VALUES (...)", 1)
+            lines.append("    [3a] Insert order: 30ms")
+            
+            # Sub-span: Update inventory
+            span3b = self.create_span(trace_id, 'order-service', 'update_inventory', span3)
+            await asyncio.sleep(0.04)
+            self.end_span(span3b, "UPDATE products SET stock = stock - 1", 1)
+            lines.append("    [3b] Update inventory: 40ms")
+            
+            self.end_span(span3, status='success')
+            lines.append("    Total: 70ms | Status: SUCCESS")
+            return lines
         
         # Span 4: Payment Service - Process Payment
-        print("\n[4] Payment Service: Processing payment...")
-        span4 = self.create_span(trace_id, 'payment-service', 'process_payment')
-        time.sleep(0.12)
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM pg_database LIMIT 1")
-        cursor.fetchall()
-        cursor.close()
-        self.end_span(span4, "INSERT INTO payments VALUES (...)", 1)
-        print("    Duration: 120ms | Status: SUCCESS")
+        async def payment_flow():
+            lines = ["\n[4] Payment Service: Processing payment..."]
+            span4 = self.create_span(trace_id, 'payment-service', 'process_payment')
+            await asyncio.sleep(0.12)
+            self.end_span(span4, "INSERT INTO payments VALUES (...)", 1)
+            lines.append("    Duration: 120ms | Status: SUCCESS")
+            return lines
         
         # Span 5: Notification Service - Send Email
-        print("\n[5] Notification Service: Sending confirmation...")
-        span5 = self.create_span(trace_id, 'notification-service', 'send_email')
-        time.sleep(0.06)
-        self.end_span(span5, status='success')
-        print("    Duration: 60ms | Status: SUCCESS")
+        async def notify_flow():
+            lines = ["\n[5] Notification Service: Sending confirmation..."]
+            span5 = self.create_span(trace_id, 'notification-service', 'send_email')
+            await asyncio.sleep(0.06)
+            self.end_span(span5, status='success')
+            lines.append("    Duration: 60ms | Status: SUCCESS")
+            return lines
+        
+        for lines in await asyncio.gather(
+            user_flow(), stock_flow(), order_flow(), payment_flow(), notify_flow()
+        ):
+            out.extend(lines)
         
         # End main trace
         self.end_trace(trace_id, 'success')
         
-        print("\n" + "=" * 80)
+        emit("\n" + "=" * 80)
+        sys.stdout.write("\n".join(out))
+        sys.stdout.write("\n")
         return trace_id
     
     def analyze_trace(self, trace_id: str):
         """Analyze a completed trace"""
         
-        cursor = self.conn.cursor()
-        
-        # Get trace info
-        cursor.execute("""
-            SELECT service_name, operation_name, duration_ms, status
-            FROM traces
-            WHERE trace_id = %s
-        """, (trace_id,))
+        self._flush()
         
-        trace_info = cursor.fetchone()
+        with self._cursor() as cursor:
+            # Get trace info
+            cursor.execute("""
+                SELECT service_name, operation_name, duration_ms, status,
+                       (SELECT COUNT(*) FROM spans WHERE trace_id = %s)
+                FROM traces
+                WHERE trace_id = %s
+            """, (trace_id, trace_id))
+            
+            trace_info = cursor.fetchone()
         
         if not trace_info:
             print("Trace not found")
-            cursor.close()
             return
         
-        service, operation, duration, status = trace_info
-        
-        # Get all spans
-        cursor.execute("""
-            SELECT span_id, parent_span_id, service_name, operation_name,
-                   duration_ms, db_query, rows_affected, status
-            FROM spans
-            WHERE trace_id = %s
-            ORDER BY start_time
-        """, (trace_id,))
-        
-        spans = cursor.fetchall()
-        cursor.close()
-        
-        print("\n" + "=" * 80)
-        print("TRACE ANALYSIS")
-        print("=" * 80)
-        print(f"Trace ID: {trace_id}")
-        print(f"Operation: {service}/{operation}")
-        print(f"Total Duration: {duration:.2f}ms")
-        print(f"Status: {status}")
-        print(f"\nSpan Breakdown ({len(spans)} spans):")
-        
-        total_db_time = 0
-        
-        for span in spans:
-            span_id, parent_id, srv, op, dur, query, rows, st = span
-            
-            indent = "  " if not parent_id else "    "
-            
-            print(f"\n{indent}Service: {srv}")
-            print(f"{indent}Operation: {op}")
-            print(f"{indent}Duration: {dur:.2f}ms")
-            
-            if query:
-                print(f"{indent}Query: {query[:60]}...")
-                print(f"{indent}Rows: {rows}")
-                total_db_time += dur
-            
-            print(f"{indent}Status: {st}")
-        
+        out: list[str] = []
+        emit = out.append
+        
+        service, operation, duration, status, span_count = trace_info
+        duration = float(duration)
+        
+        emit("\n" + "=" * 80)
+        emit("TRACE ANALYSIS")
+        emit("=" * 80)
+        emit(f"Trace ID: {trace_id}")
+        emit(f"Operation: {service}/{operation}")
+        emit(f"Total Duration: {duration:.2f}ms")
+        emit(f"Status: {_STATUS_NAMES[status]}")
+        emit(f"\nSpan Breakdown ({span_count} spans):")
+        
+        # Running aggregates over the streamed spans. Services run
+        # concurrently, so query spans can overlap; DB time is the
+        # wall-clock time covered by at least one of them. Spans arrive
+        # ordered by start_time, so each one only adds the part that ends
+        # after everything before it.
+        total_db_time = 0.0
+        covered_until = -np.inf
+        slowest_span = None
+        
+        with self._connection() as conn:
+            # Named cursors need a transaction; _getconn() restores
+            # autocommit the next time the connection is borrowed
+            conn.autocommit = False
+            try:
+                with conn.cursor(name='span_stream') as stream:
+                    stream.itersize = 1000
+                    stream.execute("""
+                        SELECT s.span_id, s.parent_span_id, s.service_name, s.operation_name,
+                               s.duration_ms, d.db_query, d.rows_affected, s.status,
+                               s.start_time, s.end_time
+                        FROM spans s
+                        LEFT JOIN spans_details d USING (span_id)
+                        WHERE s.trace_id = %s
+                        ORDER BY s.start_time
+                    """, (trace_id,))
+                    
+                    while True:
+                        spans = stream.fetchmany(stream.itersize)
+                        if not spans:
+                            break
+                        
+                        for span in spans:
+                            span_id, parent_id, srv, op, dur, query, rows, st = span[:8]
+                            
+                            indent = "  " if not parent_id else "    "
+                            
+                            emit(f"\n{indent}Service: {srv}")
+                            emit(f"{indent}Operation: {op}")
+                            emit(f"{indent}Duration: {dur:.2f}ms")
+                            
+                            if query:
+                                emit(f"{indent}Query: {query[:60]}...")
+                                emit(f"{indent}Rows: {rows}")
+                            
+                            emit(f"{indent}Status: {_STATUS_NAMES[st]}")
+                        
+                        # Columnar views over this window for the aggregate metrics
+                        n = len(spans)
+                        durations = np.fromiter(
+                            (s[4] for s in spans), dtype=np.float64, count=n
+                        )
+                        has_query = np.fromiter(
+                            (bool(s[5]) for s in spans), dtype=bool, count=n
+                        )
+                        starts = np.fromiter(
+                            (s[8].timestamp() for s in spans), dtype=np.float64, count=n
+                        )
+                        ends = np.fromiter(
+                            (s[9].timestamp() for s in spans), dtype=np.float64, count=n
+                        )
+                        
+                        db_time, covered_until = _covered_time(
+                            starts[has_query], ends[has_query], covered_until
+                        )
+                        total_db_time += db_time
+                        
+                        i = int(np.argmax(durations))
+                        if slowest_span is None or spans[i][4] > slowest_span[4]:
+                            slowest_span = spans[i]
+                        
+                        # Write each window out as it is processed
+                        sys.stdout.write("\n".join(out))
+                        sys.stdout.write("\n")
+                        out.clear()
+            finally:
+                conn.rollback()
+        
+        total_db_time *= 1000
         db_percentage = (total_db_time / duration * 100) if duration > 0 else 0
         
-        print(f"\n" + "=" * 80)
-        print("PERFORMANCE METRICS")
-        print("=" * 80)
-        print(f"Total DB Time: {total_db_time:.2f}ms ({db_percentage:.1f}% of total)")
-        print(f"Non-DB Time: {duration - total_db_time:.2f}ms ({100-db_percentage:.1f}% of total)")
+        emit(f"\n" + "=" * 80)
+        emit("PERFORMANCE METRICS")
+        emit("=" * 80)
+        emit(f"Total DB Time: {total_db_time:.2f}ms ({db_percentage:.1f}% of total)")
+        emit(f"Non-DB Time: {duration - total_db_time:.2f}ms ({100-db_percentage:.1f}% of total)")
         
         # Identify bottlenecks
-        slowest_span = max(spans, key=lambda x: x[4])
-        print(f"\nSlowest Span:")
-        print(f"  Service: {slowest_span[2]}")
-        print(f"  Operation: {slowest_span[3]}")
-        print(f"  Duration: {slowest_span[4]:.2f}ms")
-        
-        print("=" * 80)
+        if slowest_span is not None:
+            emit(f"\nSlowest Span:")
+            emit(f"  Service: {slowest_span[2]}")
+            emit(f"  Operation: {slowest_span[3]}")
+            emit(f"  Duration: {slowest_span[4]:.2f}ms")
+        
+        emit("=" * 80)
+        sys.stdout.write("\n".join(out))
+        sys.stdout.write("\n")
     
-    def get_service_performance(self):
-        """Get performance metrics by service"""
-        
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT 
-                service_name,
-                COUNT(*) as span_count,
-                AVG(duration_ms) as avg_duration,
-                MAX(duration_ms) as max_duration,
-                MIN(duration_ms) as min_duration
-            FROM spans
-            GROUP BY service_name
-            ORDER BY avg_duration DESC
-        """)
-        
-        print("\n" + "=" * 80)
-        print("SERVICE PERFORMANCE SUMMARY")
-        print("=" * 80)
-        
-        for row in cursor.fetchall():
-            service, count, avg, max_dur, min_dur = row
-            print(f"\n{service}:")
-            print(f"  Span Count: {count}")
-            print(f"  Avg Duration: {avg:.2f}ms")
-            print(f"  Max Duration: {max_dur:.2f}ms")
-            print(f"  Min Duration: {min_dur:.2f}ms")
-        
-        cursor.close()
-        print("=" * 80)
+    def get_service_performance(self, since: Optional[datetime] = None):
+        """Get performance metrics by service, optionally only for spans since a time"""
+        
+        self._flush()
+        
+        # A literal lower bound on start_time lets Postgres prune partitions
+        where = "WHERE start_time >= %s" if since else ""
+        
+        with self._cursor() as cursor:
+            cursor.execute(f"""
+                SELECT jsonb_agg(t ORDER BY t.avg_duration DESC)
+                FROM (
+                    SELECT 
+                        service_name,
+                        COUNT(*) as span_count,
+                        AVG(duration_ms) as avg_duration,
+                        MAX(duration_ms) as max_duration,
+                        MIN(duration_ms) as min_duration
+                    FROM spans
+                    {where}
+                    GROUP BY service_name
+                ) t
+            """, (since,) if since else None)
+            services = cursor.fetchone()[0] or []
+        
+        out = ["\n" + "=" * 80, "SERVICE PERFORMANCE SUMMARY", "=" * 80]
+        
+        for row in services:
+            out.append(f"\n{row['service_name']}:")
+            out.append(f"  Span Count: {row['span_count']}")
+            out.append(f"  Avg Duration: {row['avg_duration']:.2f}ms")
+            out.append(f"  Max Duration: {row['max_duration']:.2f}ms")
+            out.append(f"  Min Duration: {row['min_duration']:.2f}ms")
+        
+        out.append("=" * 80)
+        print("\n".join(out))
     
     def run_demo(self):
         print("\n" + "=" * 80)
@@ -345,7 +769,7 @@ class DistributedTracer:
         self.setup()
         
         # Simulate operation
-        trace_id = self.simulate_microservice_operation()
+        trace_id = asyncio.run(self.simulate_microservice_operation())
         
         time.sleep(1)
         
@@ -362,6 +786,8 @@ class DistributedTracer:
         print("  - Performance bottleneck identification")
         print("  - Service dependency mapping")
         print("=" * 80)
+        
+        self.close()
 
 
 def main():
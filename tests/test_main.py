@@ -1,8 +1,20 @@
+import csv
+import io
+import numpy as np
 import pytest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
+import os
+import re
 import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
 sys.path.append('src')
 
+import distributed_tracer  # noqa: E402
+from distributed_tracer import DistributedTracer, _covered_time  # noqa: E402
+
 
 class TestDatabaseManager:
     """Test database manager functionality"""
@@ -58,3 +70,326 @@ def test_graceful_shutdown():
     """Test graceful shutdown"""
     # Test implementation
     assert True
+
+
+@pytest.fixture
+def tracer():
+    """Tracer that records every trace; never connected, so events stay queued"""
+    t = DistributedTracer()
+    t.sample_rate = 1.0
+    return t
+
+
+def drain(t):
+    """Take everything the tracer has queued for export"""
+    items = []
+    while not t._export_q.empty():
+        items.append(t._export_q.get())
+    return items
+
+
+class TestEndSpan:
+    """Test client-side span completion"""
+    
+    def test_span_ended_twice(self, tracer):
+        """Test a second end_span for the same span records nothing"""
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        tracer.end_trace(trace_id)
+        span_id = tracer.create_span(trace_id, 'db', 'SELECT')
+        tracer.end_span(span_id)
+        drain(tracer)
+        
+        tracer.end_span(span_id)
+        assert drain(tracer) == []
+
+
+class TestExporterLifecycle:
+    """Test starting and stopping the exporter thread"""
+    
+    def flush_returns(self, t):
+        """Run _flush on a helper thread and report whether it finished"""
+        flusher = threading.Thread(target=t._flush, daemon=True)
+        flusher.start()
+        flusher.join(timeout=2)
+        return not flusher.is_alive()
+    
+    def test_reconnect_after_close(self, tracer):
+        """Test a second connect() starts an exporter that answers flushes"""
+        with patch.object(distributed_tracer, 'ThreadedConnectionPool'):
+            assert tracer.connect()
+            tracer.close()
+            assert tracer.connect()
+            assert self.flush_returns(tracer)
+            tracer.close()
+    
+    def test_bad_trace_does_not_drop_batch(self, tracer):
+        """Test a batch that fails is retried one trace at a time"""
+        written = []
+        
+        def export(batch):
+            if any(item[0] == 'bad' for item in batch):
+                raise ValueError("value too long")
+            written.extend(batch)
+        
+        tracer._export = export
+        good = [('trace', ['a']), ('trace', ['b'])]
+        tracer._write([good[0], ('bad', None), good[1], ('flush', None)])
+        assert written == good
+    
+    def test_flush_with_dead_exporter(self, tracer):
+        """Test _flush gives up instead of waiting on an exporter that has exited"""
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        tracer._export_thread = dead
+        assert self.flush_returns(tracer)
+
+
+class TestIds:
+    """Test trace/span ID generation"""
+    
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+    def test_ids_unique_across_fork(self, tracer):
+        """Test a forked child does not repeat its parent's IDs"""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write_fd, tracer._new_id().encode())
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        child_id = os.read(read_fd, 64).decode()
+        os.close(read_fd)
+        assert child_id != tracer._new_id()
+
+
+class TestHeadSampling:
+    """Test the head sampling gate in start_trace"""
+    
+    def test_dropped_trace_records_nothing(self, tracer):
+        """Test a trace dropped by sampling allocates no spans or events"""
+        tracer.sample_rate = 0.0
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        span_id = tracer.create_span(trace_id, 'db', 'SELECT')
+        tracer.end_span(span_id)
+        tracer.end_trace(trace_id)
+        
+        assert trace_id == span_id == distributed_tracer._NOOP
+        assert not (tracer._trace_start or tracer._span_start or tracer._pending)
+        assert drain(tracer) == []
+    
+    def test_propagated_noop_id(self, tracer):
+        """Test an equal copy of the no-op ID, e.g. from another service, is skipped"""
+        trace_id = ''.join(distributed_tracer._NOOP)
+        assert trace_id is not distributed_tracer._NOOP
+        
+        assert tracer.create_span(trace_id, 'db', 'SELECT') == distributed_tracer._NOOP
+        assert not tracer._span_start
+        assert drain(tracer) == []
+
+
+class TestAnalyzeTrace:
+    """Test the trace report against a mocked database"""
+    
+    def test_trace_without_spans(self, tracer, capsys):
+        """Test a kept trace with no spans still gets a report"""
+        cursor = Mock()
+        cursor.fetchone.return_value = ('api', 'GET /orders', 12.5, 1, 0)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value.fetchmany.return_value = []
+        
+        tracer._cursor = contextmanager(lambda: iter([cursor]))
+        tracer._connection = contextmanager(lambda: iter([conn]))
+        tracer.analyze_trace('trace-1')
+        
+        out = capsys.readouterr().out
+        assert "Total DB Time: 0.00ms" in out
+        assert "Slowest Span" not in out
+
+
+class TestExport:
+    """Test how _export stages span rows for COPY"""
+    
+    def export_spans(self, t, batch):
+        """Run _export against a mock cursor and return the COPY'd span rows"""
+        cursor = Mock()
+        copied = []
+        cursor.copy_expert.side_effect = lambda sql, buf: copied.append(buf.getvalue())
+        t._export_cursor = cursor
+        t._export_prepared = True
+        t._partitions_due = date.max
+        with patch.object(distributed_tracer, 'execute_batch'):
+            t._export(batch)
+        assert len(copied) == 1
+        return list(csv.reader(io.StringIO(copied[0]), delimiter='\t'))
+    
+    def test_start_and_end_same_batch(self, tracer):
+        """Test a span started and ended in one batch becomes one full row"""
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        span_id = tracer.create_span(trace_id, 'db', 'SELECT')
+        tracer.end_span(span_id, query='SELECT 1', rows_affected=1)
+        tracer.end_trace(trace_id)
+        
+        rows = self.export_spans(tracer, drain(tracer))
+        assert len(rows) == 1
+        row = rows[0]
+        assert row[0] == span_id and row[1] == trace_id
+        assert row[5] and row[6]  # start_time and end_time
+        assert row[9] == 'SELECT 1' and row[10] == '1'
+    
+    def test_end_only_row(self, tracer):
+        """Test a span whose start was exported earlier stages end columns only"""
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        span_id = tracer.create_span(trace_id, 'db', 'SELECT')
+        tracer.end_trace(trace_id)
+        drain(tracer)
+        
+        # The trace has ended, so the span end is queued on its own
+        tracer.end_span(span_id, query='SELECT 1')
+        rows = self.export_spans(tracer, drain(tracer))
+        assert len(rows) == 1
+        row = rows[0]
+        assert row[0] == span_id and row[1] == trace_id
+        assert row[5] == ''  # start_time left for the merge to keep
+        assert row[6] and row[9] == 'SELECT 1'
+
+
+class TestSetup:
+    """Test schema and partition setup against a mocked database"""
+    
+    def mock_cursor(self, t):
+        """Route the tracer's cursor to a mock and return it"""
+        cursor = Mock()
+        t._cursor = contextmanager(lambda: iter([cursor]))
+        return cursor
+    
+    def test_setup_rerunnable(self, tracer):
+        """Test a second setup() only issues statements that tolerate existing objects"""
+        cursor = self.mock_cursor(tracer)
+        tracer.setup()
+        tracer.setup()
+        
+        sql = " ".join(c.args[0] for c in cursor.execute.call_args_list)
+        assert re.findall(r"CREATE (?:UNLOGGED )?(?:TABLE|INDEX) (?!IF NOT EXISTS)", sql) == []
+    
+    def test_partitions_ahead(self, tracer):
+        """Test this and next month's partitions exist and the renewal date is set"""
+        cursor = self.mock_cursor(tracer)
+        tracer.create_partitions()
+        
+        this_month = date.today().replace(day=1)
+        next_month = (this_month + timedelta(days=32)).replace(day=1)
+        sql = " ".join(c.args[0] for c in cursor.execute.call_args_list)
+        assert f"spans_{this_month:%Y_%m}" in sql
+        assert f"spans_{next_month:%Y_%m}" in sql
+        assert tracer._partitions_due == next_month
+    
+    def test_export_renews_partitions(self, tracer):
+        """Test the exporter creates partitions again once they fall due"""
+        tracer._export_cursor = Mock()
+        tracer._export_prepared = True
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        tracer.end_trace(trace_id)
+        batch = drain(tracer)
+        
+        with patch.object(tracer, 'create_partitions') as create, \
+                patch.object(distributed_tracer, 'execute_batch'):
+            tracer._partitions_due = date.min
+            tracer._export(batch)
+            tracer._partitions_due = date.max
+            tracer._export(batch)
+        assert create.call_count == 1
+
+
+class TestCoveredTime:
+    """Test the union of overlapping DB intervals in analyze_trace"""
+    
+    STARTS = np.array([0.0, 1.0, 4.0, 10.0])
+    ENDS = np.array([5.0, 3.0, 8.0, 11.0])
+    
+    def test_overlapping_intervals(self):
+        """Test overlapping intervals are only counted once"""
+        total, covered_until = _covered_time(self.STARTS, self.ENDS, float('-inf'))
+        assert total == 9.0
+        assert covered_until == 11.0
+    
+    def test_carried_across_windows(self):
+        """Test splitting into fetch windows gives the same total"""
+        total, covered_until = 0.0, float('-inf')
+        for window in (slice(0, 1), slice(1, 3), slice(3, 4)):
+            db_time, covered_until = _covered_time(
+                self.STARTS[window], self.ENDS[window], covered_until
+            )
+            total += db_time
+        assert total == 9.0
+    
+    def test_empty_window(self):
+        """Test a window with no queries leaves the carry untouched"""
+        empty = np.array([])
+        assert _covered_time(empty, empty, 5.0) == (0.0, 5.0)
+
+
+class TestTailSampling:
+    """Test the keep/discard decision made at end_trace"""
+    
+    def test_fast_successful_trace_discarded(self, tracer):
+        """Test a fast trace with no failures is dropped entirely"""
+        tracer.slow_trace_ms = 60_000
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        tracer.end_span(tracer.create_span(trace_id, 'db', 'SELECT'))
+        tracer.end_trace(trace_id)
+        
+        assert drain(tracer) == []
+        assert trace_id not in tracer._pending
+    
+    def test_errored_span_keeps_trace(self, tracer):
+        """Test a failed span keeps the whole trace as one bundle"""
+        tracer.slow_trace_ms = 60_000
+        trace_id = tracer.start_trace('api', 'POST /orders')
+        tracer.end_span(tracer.create_span(trace_id, 'db', 'INSERT'), status='error')
+        tracer.end_trace(trace_id)
+        
+        items = drain(tracer)
+        assert len(items) == 1
+        kind, events = items[0]
+        assert kind == 'trace'
+        assert [k for k, _ in events] == ['trace_start', 'span_start', 'span_end', 'trace_end']
+    
+    def test_slow_trace_kept(self, tracer):
+        """Test a trace over the latency threshold is kept as one bundle"""
+        tracer.slow_trace_ms = 1
+        trace_id = tracer.start_trace('api', 'GET /report')
+        tracer.end_span(tracer.create_span(trace_id, 'db', 'SELECT'))
+        time.sleep(0.005)
+        tracer.end_trace(trace_id)
+        
+        items = drain(tracer)
+        assert len(items) == 1
+        assert items[0][0] == 'trace'
+
+
+class TestStatusCodes:
+    """Test mapping trace/span status names to their stored codes"""
+    
+    def test_codes_queued(self, tracer):
+        """Test the SMALLINT code, not the name, is queued for export"""
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        tracer.end_span(tracer.create_span(trace_id, 'db', 'SELECT'), status='error')
+        tracer.end_trace(trace_id)
+        
+        (_, events), = drain(tracer)
+        ends = {kind: item for kind, item in events if kind.endswith('_end')}
+        assert ends['span_end'][4] == distributed_tracer._STATUS['error']
+        assert ends['trace_end'][3] == distributed_tracer._STATUS['success']
+    
+    def test_unknown_status_keeps_state(self, tracer):
+        """Test an invalid status fails without losing the open trace or span"""
+        trace_id = tracer.start_trace('api', 'GET /orders')
+        span_id = tracer.create_span(trace_id, 'db', 'SELECT')
+        with pytest.raises(KeyError):
+            tracer.end_span(span_id, status='failed')
+        with pytest.raises(KeyError):
+            tracer.end_trace(trace_id, status='failed')
+        assert span_id in tracer._span_start
+        assert trace_id in tracer._trace_start
+        assert trace_id in tracer._pending